@@ -0,0 +1,68 @@
+# MIT License
+
+# Copyright 2021 NXP
+
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS
+# OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+
+# cython: language_level=3
+
+"""
+Optional compiled helper of partial_dtb_gen.py, for the "reg" to "xen,reg"
+conversion. Build it next to the script with:
+    cythonize -i _xen_reg.pyx
+"""
+
+cpdef list convert(list reg, Py_ssize_t address_cells, Py_ssize_t size_cells,
+                   unsigned long long page_size):
+    """
+    Parses a "reg" array and coverts it to "xen,reg" property
+    format, same as partial_dtb_gen.convert_to_xen_reg_prop.
+
+    :param reg: Reference to the "reg" array
+    :param page_size: Size to align addresses and sizes to
+    """
+    cdef unsigned long long page_mask = page_size - 1
+    cdef unsigned long long value
+    cdef Py_ssize_t n = len(reg)
+    cdef Py_ssize_t idx = 0
+    cdef Py_ssize_t i
+    cdef list address_cells_list
+    cdef list xen_reg = []
+
+    while idx < n:
+        # Get '#address-cells' values, rounded down to page_size
+        address_cells_list = []
+        for i in range(idx, min(idx + address_cells, n)):
+            value = reg[i]
+            address_cells_list.append(value & ~page_mask)
+
+        xen_reg.extend(address_cells_list)
+        idx += address_cells
+
+        # Get '#size-cells' values, rounded up to page_size
+        for i in range(idx, min(idx + size_cells, n)):
+            value = reg[i]
+            xen_reg.append((value + page_mask) & ~page_mask)
+
+        idx += size_cells
+
+        # Append the address once again, as per "xen,reg" format
+        xen_reg.extend(address_cells_list)
+
+    return xen_reg
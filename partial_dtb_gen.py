@@ -26,31 +26,38 @@ Dom0less VMs.
 """
 
 import argparse
-import re
 import sys
 
 # Check for Python >= 3.5
 if sys.version_info.major < 3 or sys.version_info.minor < 5:
     raise Exception("Python version should be at least 3.5")
 
+import fdt
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# libfdt Python bindings, used to read the Linux DTB when available
 try:
-    from pip import main as pipmain
+    import libfdt
 except ImportError:
-    from pip._internal import main as pipmain
+    libfdt = None
 
+# Compiled "xen,reg" conversion, built from _xen_reg.pyx
 try:
-    import fdt
+    import _xen_reg
 except ImportError:
-    pipmain(['install', '--user', 'fdt'])
-    import fdt
+    _xen_reg = None
 
 
 ADDRESS_CELLS_DEFAULT = 2
 SIZE_CELLS_DEFAULT = 2
 PAGE_SIZE = 0x1000
 
-LINUX_DT = None
-PARTIAL_DT = None
+# Properties of the passthrough node starting with these are removed
+UNWANTED_PROP_PREFIXES = ("pinctrl-",)
 
 def page_round_up(num: int):
     """
@@ -68,67 +75,305 @@ def page_round_down(num: int):
     """
     return num & ~(PAGE_SIZE - 1)
 
-def parse_memory_region_prop(target_node, reg):
+def walk_nodes(target_node):
+    """
+    Iterates over a node and all its subnodes, depth-first, in DT order
+    (each node before its subnodes, subnodes in the order they are listed).
+
+    :param target_node: Root node of the subtree to walk
+    """
+    stack = [target_node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(reversed(node.nodes))
+
+def parse_memory_region_prop(target_node, reg, phandle_map):
     """
     Parses "memory-region" property of a node, finds and returns
     all associated memory nodes from Linux DT, with a matching phandle.
+    Each memory node is returned once, in the order its phandle is first
+    listed in "memory-region".
 
     :param target_node: Source node to get "memory-region" from
-    :param reg: Reference to the "reg" property of the node,
-                to which memory-regions "reg" properties will be appended.
+    :param reg: List of the "reg" values of the node, to which
+                memory-regions "reg" values will be appended.
+    :param phandle_map: Index of Linux DT nodes, keyed by phandle ID
     """
     mem_reg_nodes = []
 
     # Check if node has a "memory-region" property
     mem_reg = target_node.get_property("memory-region")
     if mem_reg:
-        # Get all nodes with "phandle" property from Linux DT
-        phandle_props = LINUX_DT.search(name="phandle",
-                                        itype=fdt.ItemType.PROP_WORDS,
-                                        path='/')
-        for phandle_prop in phandle_props:
+        # Look up each referenced phandle only once, in property order
+        seen_phandles = set()
+        for phandle in mem_reg:
+            if phandle in seen_phandles:
+                continue
+            seen_phandles.add(phandle)
+
             # Phandle ID match
-            if phandle_prop.data[0] in mem_reg:
-                mem_reg_node = phandle_prop.parent
+            mem_reg_node = phandle_map.get(phandle)
+            if mem_reg_node is not None:
                 # Add memory-region nodes with matching phandles to list
                 mem_reg_nodes.append(mem_reg_node)
                 # Append "reg" values to list
-                for value in mem_reg_node.get_property("reg"):
-                    reg.append(value)
+                reg.extend(mem_reg_node.get_property("reg").data)
 
     return mem_reg_nodes
 
+def read_dtb(path):
+    """
+    Reads and parses a DTB file.
+
+    :param path: Path to the DTB file
+    """
+    with open(path, "rb") as fdt_file:
+        return fdt.parse_dtb(fdt_file.read())
+
+def build_phandle_map(dt):
+    """
+    Builds an index of all nodes with a "phandle" property from a DT,
+    keyed by their phandle ID.
+
+    :param dt: DT to index
+    """
+    phandle_props = dt.search(name="phandle",
+                              itype=fdt.ItemType.PROP_WORDS,
+                              path='/')
+
+    return {prop.data[0]: prop.parent for prop in phandle_props}
+
+def read_dtb_libfdt(path):
+    """
+    Reads a DTB file for libfdt, which looks nodes up directly in the
+    blob instead of parsing it into a tree of Python objects.
+
+    :param path: Path to the DTB file
+    """
+    with open(path, "rb") as fdt_file:
+        return libfdt.Fdt(fdt_file.read())
+
+def libfdt_copy_props(dtb, offset, node):
+    """
+    Appends all properties of a libfdt node to a fdt.Node.
+
+    :param dtb: libfdt DT the node is taken from
+    :param offset: Offset of the node in the libfdt DT
+    :param node: fdt.Node to append the properties to
+    """
+    prop_offset = dtb.first_property_offset(offset, libfdt.QUIET_NOTFOUND)
+    while prop_offset >= 0:
+        prop = dtb.get_property_by_offset(prop_offset)
+        node.append(fdt.new_property(prop.name, bytes(prop)))
+        prop_offset = dtb.next_property_offset(prop_offset,
+                                               libfdt.QUIET_NOTFOUND)
+
+def libfdt_to_node(dtb, offset):
+    """
+    Builds a fdt.Node, along with all its subnodes, from a libfdt node.
+
+    :param dtb: libfdt DT the node is taken from
+    :param offset: Offset of the node in the libfdt DT
+    """
+    root = None
+
+    stack = [(offset, None)]
+    while stack:
+        offset, parent = stack.pop()
+
+        node = fdt.Node(dtb.get_name(offset) or '/')
+        libfdt_copy_props(dtb, offset, node)
+        if parent is None:
+            root = node
+        else:
+            parent.append(node)
+
+        # Push subnodes in reverse, so they are appended in order
+        subnodes = []
+        subnode = dtb.first_subnode(offset, libfdt.QUIET_NOTFOUND)
+        while subnode >= 0:
+            subnodes.append(subnode)
+            subnode = dtb.next_subnode(subnode, libfdt.QUIET_NOTFOUND)
+        for subnode in reversed(subnodes):
+            stack.append((subnode, node))
+
+    return root
+
+def libfdt_get_node(dtb, offset):
+    """
+    Builds the fdt.Node at an offset of a libfdt DT, along with all its
+    subnodes. Its parents are built only with their own properties, so the
+    cell sizes can still be looked up from the node.
+
+    :param dtb: libfdt DT to take the node from
+    :param offset: Offset of the node in the libfdt DT
+    """
+    target_node = libfdt_to_node(dtb, offset)
+
+    node = target_node
+    offset = dtb.parent_offset(offset, libfdt.QUIET_NOTFOUND)
+    while offset >= 0:
+        parent = fdt.Node(dtb.get_name(offset) or '/')
+        libfdt_copy_props(dtb, offset, parent)
+        parent.append(node)
+        node = parent
+        offset = dtb.parent_offset(offset, libfdt.QUIET_NOTFOUND)
+
+    return target_node
+
+def build_phandle_map_libfdt(dtb, target_node):
+    """
+    Builds an index of the libfdt DT nodes referenced by the
+    "memory-region" properties of a node and its subnodes, keyed by their
+    phandle ID.
+
+    :param dtb: libfdt DT to take the referenced nodes from
+    :param target_node: Root node of the subtree to look for references in
+    """
+    phandle_map = {}
+
+    for node in walk_nodes(target_node):
+        mem_reg = node.get_property("memory-region")
+        if mem_reg:
+            for phandle in mem_reg:
+                if phandle in phandle_map:
+                    continue
+                # Skip unknown and invalid (0, 0xffffffff) phandles, as
+                # the fdt backend does
+                offset = dtb.node_offset_by_phandle(
+                    phandle, (libfdt.NOTFOUND, libfdt.BADPHANDLE))
+                if offset >= 0:
+                    phandle_map[phandle] = libfdt_to_node(dtb, offset)
+
+    return phandle_map
+
+def has_memory_region(target_node):
+    """
+    Checks if a node or any of its subnodes has a "memory-region"
+    property.
+
+    :param target_node: Root node of the subtree to check
+    """
+    return any(node.get_property("memory-region")
+               for node in walk_nodes(target_node))
+
+class FdtLinuxDT:
+    """
+    Linux DT backend based on fdt, which parses the whole DTB into a tree
+    of Python objects.
+
+    :param path: Path to the Linux DTB file
+    """
+    def __init__(self, path):
+        self.dt = read_dtb(path)
+
+    def get_node(self, path):
+        """
+        Returns the node at the given full path, or None.
+
+        :param path: Full path of the node
+        """
+        try:
+            return self.dt.get_node(path)
+        except ValueError:
+            return None
+
+    def get_phandle_map(self, target_node):
+        """
+        Returns an index of the nodes which can be referenced by the
+        "memory-region" properties of a subtree, keyed by phandle ID.
+
+        :param target_node: Root node of the subtree
+        """
+        if not has_memory_region(target_node):
+            return {}
+        return build_phandle_map(self.dt)
+
+    def version(self):
+        """
+        Returns the DTB version of the Linux DT.
+        """
+        return self.dt.header.version
+
+class LibfdtLinuxDT:
+    """
+    Linux DT backend based on libfdt, which looks nodes up directly in
+    the DTB and only builds fdt.Node objects for the ones returned.
+
+    :param path: Path to the Linux DTB file
+    """
+    def __init__(self, path):
+        self.dtb = read_dtb_libfdt(path)
+
+    def get_node(self, path):
+        """
+        Returns the node at the given full path, or None.
+
+        :param path: Full path of the node
+        """
+        offset = self.dtb.path_offset(path, (libfdt.NOTFOUND, libfdt.BADPATH))
+        if offset < 0:
+            return None
+        return libfdt_get_node(self.dtb, offset)
+
+    def get_phandle_map(self, target_node):
+        """
+        Returns an index of the nodes referenced by the "memory-region"
+        properties of a subtree, keyed by phandle ID.
+
+        :param target_node: Root node of the subtree
+        """
+        return build_phandle_map_libfdt(self.dtb, target_node)
+
+    def version(self):
+        """
+        Returns the DTB version of the Linux DT.
+        """
+        return self.dtb.version()
+
+def open_linux_dt(path):
+    """
+    Opens the Linux DTB with the libfdt backend if its Python bindings
+    are available, or with the fdt one otherwise.
+
+    :param path: Path to the Linux DTB file
+    """
+    if libfdt is not None:
+        return LibfdtLinuxDT(path)
+    return FdtLinuxDT(path)
+
 def search_size_cells(target_node):
     """
     Looks for "size_cells" attribute of a node from current
-    node towards parent.
+    node towards parent, and returns its value.
 
     :param target_node: Current node
     """
-    size_cells = target_node.get_property("#size-cells")
-    if not size_cells:
-        if target_node.parent:
-            size_cells = search_size_cells(target_node.parent)
-        else:
-            return SIZE_CELLS_DEFAULT
+    node = target_node
+    while node is not None:
+        size_cells = node.get_property("#size-cells")
+        if size_cells:
+            return size_cells.data[0]
+        node = node.parent
 
-    return size_cells
+    return SIZE_CELLS_DEFAULT
 
 def search_address_cells(target_node):
     """
     Looks for "address_cells" attribute of a node from current
-    node towards parent.
+    node towards parent, and returns its value.
 
     :param target_node: Current node
     """
-    address_cells = target_node.get_property("#address-cells")
-    if not address_cells:
-        if target_node.parent:
-            address_cells = search_address_cells(target_node.parent)
-        else:
-            return ADDRESS_CELLS_DEFAULT
+    node = target_node
+    while node is not None:
+        address_cells = node.get_property("#address-cells")
+        if address_cells:
+            return address_cells.data[0]
+        node = node.parent
 
-    return address_cells
+    return ADDRESS_CELLS_DEFAULT
 
 def convert_to_xen_reg_prop(reg, address_cells, size_cells):
     """
@@ -143,58 +388,121 @@ def convert_to_xen_reg_prop(reg, address_cells, size_cells):
     if size_cells == 0:
         return []
 
-    idx = 0
-    xen_reg = []
-    while idx < len(reg):
-        # Get '#address-cells' values, add them to xen_reg list
-        address_cells_list = reg[idx:idx+address_cells]
-        for i, val in enumerate(address_cells_list):
-            address_cells_list[i] = page_round_down(val)
+    # Use the compiled extension, if built
+    if _xen_reg is not None:
+        return _xen_reg.convert(reg, address_cells, size_cells,
+                                PAGE_SIZE)
 
-        xen_reg.extend(address_cells_list)
+    # Use NumPy, if available, for "reg" arrays made of whole entries
+    if numpy is not None and len(reg) % (address_cells + size_cells) == 0:
+        return convert_to_xen_reg_prop_numpy(reg, address_cells, size_cells)
+
+    # Pre-size "xen,reg" for all whole entries, each one growing from
+    # [<address_cells> <size_cells>] to [<address_cells> <size_cells>
+    # <address_cells>]
+    entries = len(reg) // (address_cells + size_cells)
+    xen_reg = [0] * (entries * (2 * address_cells + size_cells))
+
+    idx = 0
+    xen_idx = 0
+    for _ in range(entries):
+        # Get '#address-cells' values, add them to xen_reg list twice,
+        # as per "xen,reg" format
+        for i in range(address_cells):
+            address = page_round_down(reg[idx + i])
+            xen_reg[xen_idx + i] = address
+            xen_reg[xen_idx + address_cells + size_cells + i] = address
         idx += address_cells
+        xen_idx += address_cells
 
         # Get '#size-cells' values, add them to xen_reg list
         # Round them up to PAGE_SIZE, so Xen can map it
-        size_cells_list = reg[idx:idx+size_cells]
-        for i, val in enumerate(size_cells_list):
-            size_cells_list[i] = page_round_up(val)
-
-        xen_reg.extend(size_cells_list)
+        for i in range(size_cells):
+            xen_reg[xen_idx + i] = page_round_up(reg[idx + i])
         idx += size_cells
+        xen_idx += size_cells + address_cells
 
-        # Append the address once again, as per "xen,reg" format
+    # Convert the trailing incomplete entry, if any, the same way
+    if idx < len(reg):
+        address_cells_list = [page_round_down(val) for val in
+                              reg[idx:idx+address_cells]]
+        idx += address_cells
+        size_cells_list = [page_round_up(val) for val in
+                           reg[idx:idx+size_cells]]
+        xen_reg.extend(address_cells_list)
+        xen_reg.extend(size_cells_list)
         xen_reg.extend(address_cells_list)
 
     return xen_reg
 
-def add_xen_reg_prop(target_node):
+def convert_to_xen_reg_prop_numpy(reg, address_cells, size_cells):
     """
-    Creates the "xen,reg" property for a node based on
-    its "reg" property. Called recursively for all subnodes.
+    NumPy variant of convert_to_xen_reg_prop, which rounds all the
+    "reg" entries at once instead of one value at a time.
 
-    :param target_node: Source node to create "xen,reg" for
+    :param reg: Reference to the "reg" array
     """
+    page_mask = ~numpy.uint64(PAGE_SIZE - 1)
 
-    print(target_node)
-    reg = target_node.get_property("reg")
-    if not reg:
-        reg = []
+    # One row per "reg" entry: [<address_cells> <size_cells>]
+    entries = numpy.asarray(reg, dtype=numpy.uint64).reshape(
+        -1, address_cells + size_cells)
+    addresses = entries[:, :address_cells] & page_mask
+    sizes = (entries[:, address_cells:] +
+             numpy.uint64(PAGE_SIZE - 1)) & page_mask
 
-    mem_reg_nodes = parse_memory_region_prop(target_node=target_node, reg=reg)
+    return numpy.concatenate([addresses, sizes, addresses],
+                             axis=1).ravel().tolist()
 
-    # Convert "reg" array to "xen,reg"
-    address_cells = search_address_cells(target_node.parent).data[0]
-    size_cells = search_size_cells(target_node.parent).data[0]
-    xen_reg = convert_to_xen_reg_prop(reg, address_cells, size_cells)
+def add_xen_reg_prop(target_node, phandle_map, verbose=False):
+    """
+    Creates the "xen,reg" property for a node based on
+    its "reg" property. Done iteratively for all subnodes.
 
-    # Add "xen,reg" property
-    if xen_reg:
-        target_node.set_property('xen,reg', xen_reg)
+    :param target_node: Source node to create "xen,reg" for
+    :param phandle_map: Index of Linux DT nodes, keyed by phandle ID
+    :param verbose: Print each visited node
+    """
+    mem_reg_nodes = []
 
-    # Repeat for all children recursively
-    for subnode in target_node.nodes:
-        mem_reg_nodes.extend(add_xen_reg_prop(subnode))
+    # Cell sizes are resolved once for the subtree root and then inherited
+    # by each subnode from its parent, unless the parent overrides them
+    address_cells = search_address_cells(target_node.parent)
+    size_cells = search_size_cells(target_node.parent)
+
+    # Walk the subtree depth-first, in the same order as a recursive walk,
+    # carrying the cell sizes each node inherits along with it
+    stack = [(target_node, address_cells, size_cells)]
+    while stack:
+        node, address_cells, size_cells = stack.pop()
+        if verbose:
+            print(node)
+
+        # Work on a copy of the "reg" values, so that the memory-regions
+        # "reg" values only end up in "xen,reg", not in "reg" itself
+        reg_prop = node.get_property("reg")
+        reg = list(reg_prop.data) if reg_prop else []
+
+        mem_reg_nodes.extend(parse_memory_region_prop(
+            target_node=node, reg=reg, phandle_map=phandle_map))
+
+        # Convert "reg" array to "xen,reg", unless there is nothing to map
+        if reg:
+            xen_reg = convert_to_xen_reg_prop(reg, address_cells, size_cells)
+
+            # Add "xen,reg" property
+            if xen_reg:
+                node.set_property('xen,reg', xen_reg)
+
+        # Repeat for all children, with the cell sizes defined by this node
+        child_address_cells = node.get_property("#address-cells")
+        child_size_cells = node.get_property("#size-cells")
+        if child_address_cells:
+            address_cells = child_address_cells.data[0]
+        if child_size_cells:
+            size_cells = child_size_cells.data[0]
+        for subnode in reversed(node.nodes):
+            stack.append((subnode, address_cells, size_cells))
 
     return mem_reg_nodes
 
@@ -216,8 +524,6 @@ def main():
     reads the DT files, takes the specified node from the Linux DT and adds
     it to the template DT, along with constructing its xen-specific properties.
     """
-    global LINUX_DT, PARTIAL_DT
-
     parser = parse_args()
     arguments = parser.parse_args()
     if arguments.linux_dt is None:
@@ -229,30 +535,31 @@ def main():
     if arguments.passthrough_node is None:
         arg_parse_error("No path to passthrough node passed as argument.",
                         parser)
+    if not arguments.passthrough_node.startswith('/'):
+        arg_parse_error("Path to passthrough node should be a full path.",
+                        parser)
 
     # Open Linux DTB
-    with open(arguments.linux_dt, "rb") as fdt_file:
-        LINUX_DT = fdt.parse_dtb(fdt_file.read())
+    linux_dt = open_linux_dt(arguments.linux_dt)
 
     # Open Template DTS/DTB
     if "dtb" in arguments.template_dt.split('.')[-1]:
-        with open(arguments.template_dt, "rb") as fdt_file:
-            PARTIAL_DT = fdt.parse_dtb(fdt_file.read())
+        partial_dt = read_dtb(arguments.template_dt)
     elif "dts" in arguments.template_dt.split('.')[-1]:
         with open(arguments.template_dt, "r") as fdt_file:
-            PARTIAL_DT = fdt.parse_dts(fdt_file.read())
+            partial_dt = fdt.parse_dts(fdt_file.read())
     else:
         raise Exception("Please provide a Template \".dts\" or \".dtb\"" +
                         "-terminated file, accordingly.")
 
     # Search for wanted node in Linux DTB
     passthrough_node = arguments.passthrough_node.split('/')[-1]
-    target_node_list = LINUX_DT.search(name=passthrough_node,
-                                       itype=fdt.ItemType.NODE,
-                                       path='/')
-    if not target_node_list:
+    target_node = linux_dt.get_node(arguments.passthrough_node)
+    if target_node is None:
         raise Exception("Requested node not found")
-    target_node = target_node_list[0]
+
+    # Index Linux DT nodes by phandle
+    phandle_map = linux_dt.get_phandle_map(target_node)
 
     # Modify attributes of wanted node
     # Add "xen,path" attribute
@@ -262,29 +569,42 @@ def main():
     target_node.append(fdt.Property('xen,force-assign-without-iommu'))
 
     # Add "xen,reg" attribute
-    mem_reg_nodes = add_xen_reg_prop(target_node)
+    mem_reg_nodes = add_xen_reg_prop(target_node, phandle_map,
+                                     arguments.verbose)
 
-    # Add memory region nodes to new DT
+    # Node to add items to in new DT, resolved (and created, if missing)
+    # only once, when the first item is added to it
+    passthrough_parent = None
+
+    # Add memory region nodes to new DT, once each, as several subnodes
+    # may reference the same memory region (fdt.Node is not hashable)
+    added_nodes = set()
     for mem_reg_node in mem_reg_nodes:
-        PARTIAL_DT.add_item(mem_reg_node, path='/passthrough')
+        if id(mem_reg_node) in added_nodes:
+            continue
+        added_nodes.add(id(mem_reg_node))
+        if passthrough_parent is None:
+            passthrough_parent = partial_dt.get_node('/passthrough',
+                                                     create=True)
+        passthrough_parent.append(mem_reg_node)
 
     # Remove unwanted properties
-    pattern = re.compile("pinctrl-.*")
-    found_props = []
-    for prop in target_node.props:
-        if re.search(pattern, prop.name):
-            found_props.append(prop.name)
+    found_props = [prop.name for prop in target_node.props
+                   if prop.name.startswith(UNWANTED_PROP_PREFIXES)]
 
     for prop in found_props:
         target_node.remove_property(prop)
 
     # Add passthrough node in new DT
-    template_node_list = PARTIAL_DT.search(name=passthrough_node,
-                                    itype=fdt.ItemType.NODE,
-                                    path='/')
+    template_node_list = partial_dt.search(name=passthrough_node,
+                                           itype=fdt.ItemType.NODE,
+                                           path='/')
     if not template_node_list:
         # Node doesn't already exist => Add full node
-        PARTIAL_DT.add_item(target_node, path='/passthrough')
+        if passthrough_parent is None:
+            passthrough_parent = partial_dt.get_node('/passthrough',
+                                                     create=True)
+        passthrough_parent.append(target_node)
     else:
         # Get node from new DT
         template_node = template_node_list[0]
@@ -292,8 +612,16 @@ def main():
         # Merge node attributes (template <- template | original)
         template_node.merge(target_node, replace=False)
 
-    with open("passthrough.dts", "w") as fdt_file:
-        fdt_file.write(PARTIAL_DT.to_dts())
+    # Write new DT
+    if arguments.output_format == "dtb":
+        # A DTS template carries no DTB version => Reuse the Linux DTB one
+        if partial_dt.header.version is None:
+            partial_dt.header.version = linux_dt.version()
+        with open("passthrough.dtb", "wb") as fdt_file:
+            fdt_file.write(partial_dt.to_dtb())
+    else:
+        with open("passthrough.dts", "w") as fdt_file:
+            fdt_file.write(partial_dt.to_dts())
 
 def parse_args():
     """
@@ -313,6 +641,15 @@ def parse_args():
                         help='''Full path of node to be passthroughed, taken
                                 from Linux DT as-is (e.g. "/ethernet@4033c000")
                         ''')
+    parser.add_argument('-f', '--output_format', dest='output_format',
+                        choices=['dts', 'dtb'], default='dts',
+                        help='''Format of the Partial DT output file,
+                                "passthrough.dts" or "passthrough.dtb"
+                                (default: dts)''')
+    parser.add_argument('-v', '--verbose', dest='verbose',
+                        action='store_true',
+                        help='''Print the nodes visited while creating their
+                                "xen,reg" properties''')
 
     return parser
 